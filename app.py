@@ -1,16 +1,9 @@
 # app.py
-import argparse, os, sys, subprocess, shlex, pathlib
-
-HERE = pathlib.Path(__file__).parent.resolve()
-
-def run(cmd_list):
-    print("▶", " ".join(shlex.quote(c) for c in cmd_list))
-    p = subprocess.Popen(cmd_list, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
-    for line in p.stdout:
-        print(line, end="")
-    p.wait()
-    if p.returncode != 0:
-        raise SystemExit(f"❌ step failed: {p.returncode}")
+import argparse, os
+import fitz  # PyMuPDF
+import jsonio
+# the hyphen-named scripts, loaded as modules (registered so the OCR process pool can pickle them)
+from pipeline import pos_ocr, pii_identifier, redactor
 
 def main():
     ap = argparse.ArgumentParser(description="PDF → OCR → (PII) → Redact pipeline")
@@ -31,26 +24,30 @@ def main():
     with_pii  = f"{out_base}.with_pii.json"
     redacted  = f"{out_base}.redacted.pdf"
 
-    # step 1 OCR
-    if not os.path.exists(positions):
-        print("\n=== Step 1: OCR ===")
-        run([sys.executable, str(HERE / "pos-ocr.py"), pdf, out_base])
-    else:
-        print(f"ℹ using existing {positions}")
-
-    # step 2 PII
-    if not args.skip_pii:
-        print("\n=== Step 2: PII Identify ===")
-        run([sys.executable, str(HERE / "pii-identifier.py"), positions, with_pii])
-    else:
-        print("ℹ skipping PII")
-
-    # step 3 Redact
-    if not args.skip_redact:
-        print("\n=== Step 3: Redact ===")
-        run([sys.executable, str(HERE / "redactor.py"), pdf, with_pii, redacted])
-    else:
-        print("ℹ skipping redact")
+    # one document handle for the whole run (OCR page count + redaction)
+    with fitz.open(pdf) as doc:
+        # step 1 OCR
+        if not os.path.exists(positions):
+            print("\n=== Step 1: OCR ===")
+            positions_data = pos_ocr.run_ocr(pdf, out_base, doc=doc)
+        else:
+            print(f"ℹ using existing {positions}")
+            positions_data = jsonio.load(positions)
+
+        # step 2 PII
+        if not args.skip_pii:
+            print("\n=== Step 2: PII Identify ===")
+            pii_data = pii_identifier.run_pii(positions_data, with_pii)
+        else:
+            print("ℹ skipping PII")
+            pii_data = with_pii  # redactor reads an existing with_pii file
+
+        # step 3 Redact
+        if not args.skip_redact:
+            print("\n=== Step 3: Redact ===")
+            redactor.run_redact(pdf, pii_data, redacted, doc=doc)
+        else:
+            print("ℹ skipping redact")
 
     print("\n✅ pipeline complete")
     print("positions:", positions)
@@ -59,4 +56,3 @@ def main():
 
 if __name__ == "__main__":
     main()
-reamlit_app.py
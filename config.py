@@ -4,10 +4,16 @@ from dotenv import load_dotenv
 load_dotenv()
 
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY", "")
+# optional pool of keys (comma-separated) rotated per request; falls back to the single key
+GEMINI_API_KEYS = [k.strip() for k in os.getenv("GEMINI_API_KEYS", "").split(",") if k.strip()] \
+    or ([GEMINI_API_KEY] if GEMINI_API_KEY else [])
 GEMINI_MODEL = os.getenv("GEMINI_MODEL", "gemini-2.0-flash")
 REQUEST_TIMEOUT_MS = int(os.getenv("REQUEST_TIMEOUT_MS", "45000"))
 MAX_WORDS_PER_CHUNK = int(os.getenv("MAX_WORDS_PER_CHUNK", "600"))
+GEMINI_CONCURRENCY = int(os.getenv("GEMINI_CONCURRENCY", "8"))
+# skip Gemini for a chunk when regex leaves less than this fraction of its words untagged
+GEMINI_MIN_UNCOVERED = float(os.getenv("GEMINI_MIN_UNCOVERED", "0.2"))
 
 def assert_env():
-    if not GEMINI_API_KEY:
-        raise SystemExit("GEMINI_API_KEY missing. Put it in .env")
+    if not GEMINI_API_KEYS:
+        raise SystemExit("GEMINI_API_KEY (or GEMINI_API_KEYS) missing. Put it in .env")
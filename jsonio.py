@@ -0,0 +1,76 @@
+# jsonio.py — JSON file I/O shared by the pipeline scripts.
+# Uses orjson when installed (C serializer, emits bytes directly); otherwise
+# falls back to the stdlib json module with the same output layout.
+import json
+import mmap
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:  # incremental parser for streaming large files page by page
+    import ijson
+except ImportError:
+    ijson = None
+
+def loads(data: bytes | str):
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+def dumps(obj, indent: bool = True) -> bytes:
+    """Serialize to UTF-8 bytes (2-space indent by default)."""
+    if orjson is not None:
+        option = orjson.OPT_NON_STR_KEYS | (orjson.OPT_INDENT_2 if indent else 0)
+        return orjson.dumps(obj, option=option)
+    return json.dumps(obj, indent=2 if indent else None, ensure_ascii=False).encode("utf-8")
+
+def load(path):
+    """
+    Parse a JSON file. With orjson the file is memory-mapped and parsed in place,
+    so no intermediate bytes copy of a large file is made.
+    """
+    with open(path, "rb") as f:
+        if orjson is not None:
+            try:
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:  # empty file: can't map zero bytes
+                return loads(b"")
+            with mm, memoryview(mm) as view:
+                return orjson.loads(view)
+        return loads(f.read())
+
+def dump(obj, path, indent: bool = True) -> None:
+    with open(path, "wb") as f:
+        f.write(dumps(obj, indent=indent))
+
+def iter_pages(path):
+    """
+    Yield the objects of the top-level "pages" array one at a time.
+    Streams with ijson when installed (peak memory ~ one page); otherwise loads the whole file.
+    """
+    if ijson is not None:
+        with open(path, "rb") as f:
+            yield from ijson.items(f, "pages.item", use_float=True)
+    else:
+        yield from (load(path).get("pages") or [])
+
+def has_pages(path, probe: int = 4096) -> bool:
+    """
+    True if path holds a JSON object whose top-level "pages" is an array.
+    Sniffs the first `probe` bytes, then (with ijson) reads only up to the "pages" key.
+    """
+    with open(path, "rb") as f:
+        head = f.read(probe)
+        if not head.lstrip().startswith(b"{") or b'"pages"' not in head:
+            return False
+        if ijson is None:
+            data = loads(head + f.read())
+            return isinstance(data.get("pages"), list)
+        f.seek(0)
+        parser = ijson.parse(f)
+        for prefix, event, value in parser:
+            if prefix == "" and event == "map_key" and value == "pages":
+                return next(parser)[1] == "start_array"
+    return False
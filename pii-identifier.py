@@ -1,53 +1,88 @@
 
 
+import argparse
+import asyncio
 import json
-import sys
+import random
 import time
 import re
-import requests
+import httpx
+import jsonio
+from collections import deque
 from typing import List, Dict, Any, Tuple
 from config import (
-    GEMINI_API_KEY,
+    GEMINI_API_KEYS,
     GEMINI_MODEL,
+    GEMINI_CONCURRENCY,
     REQUEST_TIMEOUT_MS,
     MAX_WORDS_PER_CHUNK,
+    GEMINI_MIN_UNCOVERED,
     assert_env,
 )
 
 # ----------------- basic regex fallback -----------------
-EMAIL_RE = re.compile(r"[A-Z0-9._%+-]+@[A-Z0-9.-]+\.[A-Z]{2,}", re.I)
-PHONE_RE = re.compile(r"(?:(?:\+?\d{1,3}[-.\s]?)?(?:\(?\d{2,4}\)?[-.\s]?)?\d{3,4}[-.\s]?\d{3,4})")
+# word-bounded, literal-led patterns; callers prefilter on "@" / "." before searching
+EMAIL_RE = re.compile(r"\b[A-Z0-9._%+-]+@[A-Z0-9.-]+\.[A-Z]{2,}\b", re.I)
+PHONE_RE = re.compile(
+    r"(?<!\w)(?:"
+    r"(?:\+\d{1,3}[-.\s]?)?\(?\d{2,4}\)?[-.\s]?\d{3,4}[-.\s]?\d{3,4}"  # +1 415 555 0132, (555) 123-4567, +44 20 7946 0958
+    r"|(?:\+\d{1,3}[-.\s]?)?\d{5}[-.\s]?\d{5}"                          # +91 98765 43210, 98765-43210
+    r"|\d{3}[-.\s]?\d{4}"                                                 # 555-1234
+    r")(?!\w)"
+)
+PHONE_SPAN = 5  # tokens joined when looking for a phone number; "+1 (415) 555 0132" is four
 IPV4_RE  = re.compile(r"\b(?:\d{1,3}\.){3}\d{1,3}\b")
-ADDR_CUES = {
+ADDR_CUES = frozenset({
     "street","st.","road","rd.","avenue","ave","sector","block","phase",
     "colony","lane","ln","plot","apt","flat","suite","zip","pincode","pin",
     "city","state"
-}
+})
+# one alternation for all cues (longest first); lookarounds rather than \b so "st." / "rd." still match
+ADDR_RE = re.compile(
+    r"(?<!\w)(?:" + "|".join(re.escape(c) for c in sorted(ADDR_CUES, key=len, reverse=True)) + r")(?!\w)",
+    re.I,
+)
 
-def regex_pii_indices(words: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
-    out = []
+def regex_pii_indices(words: List[Dict[str, Any]], address: bool = True) -> List[Dict[str, Any]]:
+    """Regex tags for email / ip / phone; with address=True also every word near an address cue.
+    The address window is loose (any "city", "block", "pin" ... nearby), so it is only a fallback."""
+    result: Dict[int, str] = {}  # index -> type; first matching rule wins
     win = 5
-    for i, w in enumerate(words):
-        t = (w.get("text") or "").strip()
-        if not t:
+    n = len(words)
+    texts = [(w.get("text") or "") for w in words]
+    # cue test once per token; the address window [i-win, i+win) then slides with a running count
+    has_cue = [ADDR_RE.search(t) is not None for t in texts] if address else [False] * n
+    window_cues = sum(has_cue[:win])
+    for i in range(n):
+        if i > 0:
+            enter, leave = i + win - 1, i - win - 1
+            if enter < n and has_cue[enter]:
+                window_cues += 1
+            if leave >= 0 and has_cue[leave]:
+                window_cues -= 1
+        t = texts[i].strip()
+        if not t or i in result:
             continue
-        if EMAIL_RE.search(t):
-            out.append({"index": i, "type": "email"}); continue
-        if IPV4_RE.search(t):
-            out.append({"index": i, "type": "ip"}); continue
-        span = " ".join((words[j].get("text") or "") for j in range(i, min(i+3, len(words))))
-        if PHONE_RE.search(span):
-            out.append({"index": i, "type": "phone"}); continue
-        window = " ".join((words[j].get("text") or "").lower()
-                          for j in range(max(0, i-win), min(len(words), i+win)))
-        if any(cue in window for cue in ADDR_CUES):
-            out.append({"index": i, "type": "address"}); continue
-    # distinct by index
-    seen = set(); dedup = []
-    for r in out:
-        if r["index"] not in seen:
-            dedup.append(r); seen.add(r["index"])
-    return dedup
+        if "@" in t and EMAIL_RE.search(t):
+            result.setdefault(i, "email"); continue
+        if "." in t and IPV4_RE.search(t):
+            result.setdefault(i, "ip"); continue
+        # phone numbers start on a digit-bearing token; only then build the span
+        if any(ch.isdigit() for ch in t):
+            m = PHONE_RE.search(" ".join(texts[i:i + PHONE_SPAN]))
+            if m and m.start() < len(texts[i]):
+                # tag every token the match covers, not just the one it starts on
+                end, j = len(texts[i]), i
+                while True:
+                    result.setdefault(j, "phone")
+                    j += 1
+                    if j >= n or end + 1 >= m.end():
+                        break
+                    end += 1 + len(texts[j])
+                continue
+        if window_cues > 0:
+            result.setdefault(i, "address"); continue
+    return [{"index": i, "type": t} for i, t in result.items()]
 
 # ----------------- Gemini v1beta: generateContent -----------------
 def _endpoint(model: str) -> str:
@@ -66,20 +101,18 @@ def _build_prompt(words: List[Dict[str, Any]]) -> str:
     listing = "\n".join(f"{i}: {json.dumps(str(w.get('text','')))}" for i, w in enumerate(words))
     return f"{header}\n{listing}"
 
-def _call_gemini(words: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
-    url = _endpoint(GEMINI_MODEL)
-    body = {
+def _request_body(words: List[Dict[str, Any]]) -> Dict[str, Any]:
+    return {
         "contents": [
             {"role": "user", "parts": [{"text": _build_prompt(words)}]}
         ],
         "generationConfig": { "response_mime_type": "application/json" }
     }
-    params = {"key": GEMINI_API_KEY}
-    res = requests.post(url, params=params, json=body, timeout=REQUEST_TIMEOUT_MS/1000)
-    res.raise_for_status()
-    data = res.json()
+
+def _parse_response(data: Dict[str, Any], n_words: int) -> List[Dict[str, Any]]:
+    """Pull the redaction list out of a generateContent response body."""
     text = (
-        data.get("candidates", [{}])[0]
+        (data.get("candidates") or [{}])[0]
             .get("content", {})
             .get("parts", [{}])[0]
             .get("text", "")
@@ -93,12 +126,80 @@ def _call_gemini(words: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
         for r in red:
             idx = r.get("index")
             typ = str(r.get("type", "other"))
-            if isinstance(idx, int) and 0 <= idx < len(words):
+            if isinstance(idx, int) and 0 <= idx < n_words:
                 out.append({"index": idx, "type": typ})
         return out
     except Exception:
         return []
 
+class KeyPool:
+    """Round-robin over API keys, skipping keys that are cooling off after a 429."""
+
+    def __init__(self, keys: List[str]):
+        self._keys = deque(keys)
+        self._ready_at: Dict[str, float] = {}  # key -> monotonic time it may be used again
+
+    def get(self) -> str:
+        now = time.monotonic()
+        for _ in range(len(self._keys)):
+            key = self._keys[0]
+            self._keys.rotate(-1)
+            if self._ready_at.get(key, 0.0) <= now:
+                return key
+        # every key is cooling off: hand out the one that frees up first
+        return min(self._keys, key=lambda k: self._ready_at.get(k, 0.0))
+
+    def wait_time(self, key: str) -> float:
+        return max(0.0, self._ready_at.get(key, 0.0) - time.monotonic())
+
+    def cooldown(self, key: str, seconds: float) -> None:
+        self._ready_at[key] = time.monotonic() + seconds
+
+_KEYS = KeyPool(GEMINI_API_KEYS)
+
+def _retry_after(res: httpx.Response, default: int = 30) -> int:
+    try:
+        return int(res.headers.get("Retry-After", default))
+    except ValueError:  # HTTP-date form
+        return default
+
+MAX_RETRIES = 4
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+def _new_session() -> httpx.AsyncClient:
+    """Keep-alive client shared by every request of a run, so chunks reuse pooled TLS connections."""
+    transport = httpx.AsyncHTTPTransport(
+        retries=2,  # reconnect when a pooled socket was dropped
+        limits=httpx.Limits(max_connections=GEMINI_CONCURRENCY, max_keepalive_connections=GEMINI_CONCURRENCY),
+    )
+    return httpx.AsyncClient(
+        transport=transport,
+        headers={"Content-Type": "application/json"},
+        timeout=REQUEST_TIMEOUT_MS / 1000,
+    )
+
+async def _call_gemini_async(session: httpx.AsyncClient, words: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    url = _endpoint(GEMINI_MODEL)
+    body = jsonio.dumps(_request_body(words), indent=False)  # serialized once, reused across retries
+    for attempt in range(MAX_RETRIES + 1):
+        key = _KEYS.get()
+        wait = _KEYS.wait_time(key)
+        if wait:
+            await asyncio.sleep(wait)
+        res = await session.post(url, content=body, params={"key": key})
+        if res.status_code == 429:
+            # sideline this key and retry straight away with the next one
+            _KEYS.cooldown(key, _retry_after(res))
+            if attempt < MAX_RETRIES:
+                continue
+        elif res.status_code in RETRY_STATUS and attempt < MAX_RETRIES:
+            # exponential backoff with jitter on transient server errors
+            await asyncio.sleep(0.5 * 2 ** attempt + random.uniform(0, 0.25))
+            continue
+        res.raise_for_status()
+        return _parse_response(res.json(), len(words))
+    return []
+
 def _chunk(seq: List[Any], size: int) -> List[Tuple[int, List[Any]]]:
     return [(i, seq[i:i+size]) for i in range(0, len(seq), size)]
 
@@ -108,51 +209,168 @@ def _mark(words: List[Dict[str, Any]], red: List[Dict[str, Any]], start: int) ->
         if 0 <= idx < len(words):
             words[idx]["pii"] = {"is_pii": True, "type": r.get("type", "other")}
 
-def tag_page(words: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
-    # copy + default pii flag
-    tagged = [{**w, "pii": {"is_pii": False, "type": None}} for w in words]
-    for start, chunk_items in _chunk(tagged, MAX_WORDS_PER_CHUNK):
-        red = []
+def _plan_chunk(chunk_items: List[Dict[str, Any]]) -> Tuple[List[Dict[str, Any]], List[int]]:
+    """Pre-tag a chunk's high-precision email / ip / phone hits; return (those hits,
+    chunk positions to send to Gemini, empty = skip Gemini)."""
+    regex_hits = regex_pii_indices(chunk_items, address=False)
+    covered = {r["index"] for r in regex_hits}
+    uncovered = [i for i, w in enumerate(chunk_items)
+                 if i not in covered and (w.get("text") or "").strip()]
+    if len(uncovered) < GEMINI_MIN_UNCOVERED * len(chunk_items):
+        return regex_hits, []
+    return regex_hits, uncovered
+
+def _remap(red: List[Dict[str, Any]], sent: List[int]) -> List[Dict[str, Any]]:
+    # Gemini indexes into the sub-list it was given; map back to chunk positions
+    return [{"index": sent[r["index"]], "type": r["type"]} for r in red]
+
+def _merge_hits(chunk_items: List[Dict[str, Any]], regex_hits: List[Dict[str, Any]],
+                red: List[Dict[str, Any]], sent: List[int]) -> List[Dict[str, Any]]:
+    """Pre-tagged hits plus Gemini's answer; if Gemini was asked but gave nothing,
+    fall back to the full regex tagger (address window included)."""
+    if sent and not red:
+        return regex_pii_indices(chunk_items)
+    return regex_hits + _remap(red, sent)
+
+async def _tag_chunk(session: httpx.AsyncClient, sem: asyncio.Semaphore,
+                     chunk_items: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    regex_hits, sent = _plan_chunk(chunk_items)
+    if not sent:
+        return regex_hits
+    async with sem:
         try:
-            red = _call_gemini(chunk_items)
+            red = await _call_gemini_async(session, [chunk_items[i] for i in sent])
         except Exception:
             red = []
-        if not red:
-            red = regex_pii_indices(chunk_items)
+    return _merge_hits(chunk_items, regex_hits, red, sent)
+
+async def _tag_page_async(session: httpx.AsyncClient, sem: asyncio.Semaphore,
+                          words: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    # copy + default pii flag
+    tagged = [{**w, "pii": {"is_pii": False, "type": None}} for w in words]
+    chunks = _chunk(tagged, MAX_WORDS_PER_CHUNK)
+    reds = await asyncio.gather(*(_tag_chunk(session, sem, chunk_items) for _, chunk_items in chunks))
+    for (start, _), red in zip(chunks, reds):
         _mark(tagged, red, start)
-        time.sleep(0.15)  # gentle rate-limit
     return tagged
 
-def main():
-    assert_env()
-    if len(sys.argv) < 2:
-        print("Usage: python pii_identify.py input.positions.json [output.with_pii.json]")
-        sys.exit(1)
+async def _tag_pages_async(pages_words: List[List[Dict[str, Any]]]) -> List[List[Dict[str, Any]]]:
+    # one connection pool for the whole document; the semaphore caps in-flight requests
+    sem = asyncio.Semaphore(GEMINI_CONCURRENCY)
+    async with _new_session() as session:
+        return list(await asyncio.gather(*(_tag_page_async(session, sem, words) for words in pages_words)))
+
+def tag_pages(pages_words: List[List[Dict[str, Any]]]) -> List[List[Dict[str, Any]]]:
+    """Tag every page, running Gemini chunk requests concurrently across the whole document."""
+    return asyncio.run(_tag_pages_async(pages_words))
+
+def tag_page(words: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    return tag_pages([words])[0]
 
-    in_path = sys.argv[1]
-    out_path = sys.argv[2] if len(sys.argv) > 2 else re.sub(r"\.json$", "", in_path) + ".with_pii.json"
+# ----------------- Gemini Batch Mode: one job per document -----------------
+BATCH_POLL_SECONDS = 10
+_BATCH_DONE = {"JOB_STATE_SUCCEEDED", "JOB_STATE_FAILED", "JOB_STATE_CANCELLED", "JOB_STATE_EXPIRED"}
 
-    with open(in_path, "r", encoding="utf-8") as f:
-        data = json.load(f)
+def write_batch_requests(pages_words: List[List[Dict[str, Any]]],
+                         jsonl_path: str) -> Dict[str, Tuple[int, int, List[Dict[str, Any]], List[int]]]:
+    """Plan every chunk of every page and write a request line for those still needing Gemini.
+    Returns key -> (page idx, chunk start, regex hits, positions sent to Gemini)."""
+    plans = {}
+    with open(jsonl_path, "wb") as f:
+        for p, words in enumerate(pages_words):
+            for start, chunk_items in _chunk(words, MAX_WORDS_PER_CHUNK):
+                key = f"p{p}_c{start}"
+                regex_hits, sent = _plan_chunk(chunk_items)
+                plans[key] = (p, start, regex_hits, sent)
+                if sent:
+                    body = _request_body([chunk_items[i] for i in sent])
+                    f.write(jsonio.dumps({"key": key, "request": body}, indent=False) + b"\n")
+    return plans
+
+def _run_batch_job(jsonl_path: str) -> bytes:
+    from google import genai  # only needed for --batch
+
+    client = genai.Client(api_key=_KEYS.get())
+    uploaded = client.files.upload(file=jsonl_path, config={"display_name": "pii", "mime_type": "jsonl"})
+    job = client.batches.create(model=GEMINI_MODEL, src=uploaded.name, config={"display_name": "pii"})
+    while job.state.name not in _BATCH_DONE:
+        time.sleep(BATCH_POLL_SECONDS)
+        job = client.batches.get(name=job.name)
+    if job.state.name != "JOB_STATE_SUCCEEDED":
+        raise RuntimeError(f"batch job {job.name} ended in {job.state.name}")
+    return client.files.download(file=job.dest.file_name)  # JSONL bytes
+
+def tag_pages_batch(pages_words: List[List[Dict[str, Any]]], jsonl_path: str) -> List[List[Dict[str, Any]]]:
+    """Tag every page with a single Batch Mode job; chunks without a usable answer fall back to the regex tagger."""
+    tagged_pages = [[{**w, "pii": {"is_pii": False, "type": None}} for w in words] for words in pages_words]
+    plans = write_batch_requests(tagged_pages, jsonl_path)
+    results = {}
+    if any(sent for _, _, _, sent in plans.values()):
+        try:
+            for line in _run_batch_job(jsonl_path).splitlines():
+                if not line.strip():
+                    continue
+                try:
+                    rec = jsonio.loads(line)
+                except Exception:
+                    continue
+                key = rec.get("key")
+                if key in plans and isinstance(rec.get("response"), dict):
+                    results[key] = _parse_response(rec["response"], len(plans[key][3]))
+        except Exception as e:
+            print(f"batch job failed, falling back to regex tagging: {e}")
+
+    for key, (p, start, regex_hits, sent) in plans.items():
+        chunk_items = tagged_pages[p][start:start + MAX_WORDS_PER_CHUNK]
+        _mark(tagged_pages[p], _merge_hits(chunk_items, regex_hits, results.get(key, []), sent), start)
+    return tagged_pages
+
+def run_pii(positions: str | Dict[str, Any], out_path: str | None = None, batch: bool = False) -> Dict[str, Any]:
+    """Tag the words of a positions JSON (path or already-loaded dict), write the with_pii JSON and return it."""
+    assert_env()
+    if isinstance(positions, dict):
+        if not out_path:
+            raise SystemExit("run_pii: out_path is required when passing positions data")
+        data = positions
+    else:
+        out_path = out_path or re.sub(r"\.json$", "", positions) + ".with_pii.json"
+        data = jsonio.load(positions)
     pages = data.get("pages", [])
     if not isinstance(pages, list):
         raise SystemExit("Invalid positions JSON: missing 'pages' array")
 
+    pages_words = [page.get("words", []) for page in pages]
+    if batch:
+        jsonl_path = re.sub(r"\.json$", "", out_path) + ".batch_requests.jsonl"
+        tagged_pages = tag_pages_batch(pages_words, jsonl_path)
+    else:
+        tagged_pages = tag_pages(pages_words)
+
     result = {"pages": []}
-    for page in pages:
-        words = page.get("words", [])
-        tagged = tag_page(words)
-        result["pages"].append({
+    for page, tagged in zip(pages, tagged_pages):
+        out_page = {
             "page": page.get("page"),
             "width": page.get("width"),
             "height": page.get("height"),
             "words": tagged
-        })
+        }
+        if "dpi" in page:  # per-page render DPI from pos-ocr; redactor scales boxes with it
+            out_page["dpi"] = page["dpi"]
+        result["pages"].append(out_page)
         print(f"page {page.get('page')}: tagged {sum(1 for w in tagged if w['pii']['is_pii'])} PII tokens")
 
-    with open(out_path, "w", encoding="utf-8") as f:
-        json.dump(result, f, indent=2)
+    jsonio.dump(result, out_path)
     print(f" wrote {out_path}")
+    return result
+
+def main():
+    ap = argparse.ArgumentParser(description="Tag OCR words as PII (Gemini + regex fallback)")
+    ap.add_argument("in_path", help="Input *.positions.json")
+    ap.add_argument("out_path", nargs="?", help="Output *.with_pii.json (default: derived from input)")
+    ap.add_argument("--batch", action="store_true",
+                    help="Submit all chunks as one Gemini Batch Mode job (slower turnaround, half the cost)")
+    args = ap.parse_args()
+    run_pii(args.in_path, args.out_path, batch=args.batch)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,140 @@
+# pii_report.py — redaction report (summary + per-hit columns) built from with_pii data,
+# with JSON / CSV exports for the Streamlit app
+import bisect
+import csv
+import io
+import json
+import pathlib
+from typing import Any, Iterable
+
+import jsonio
+from pii_types import PII_CATEGORIES, normalize_type
+
+REPORT_FIELDS = ("page", "index", "type", "source", "text", "confidence", "bbox", "page_width", "page_height", "context")
+PREVIEW_FIELDS = ("page", "type", "source", "text", "confidence", "context")
+# CSV takes the bbox pre-serialized at build time
+_CSV_SOURCES = tuple("bbox_json" if k == "bbox" else k for k in REPORT_FIELDS)
+_COLUMNS = REPORT_FIELDS + ("bbox_json",)
+
+def _safe_text(x: Any) -> str:
+    s = x if isinstance(x, str) else ("" if x is None else str(x))
+    return s.strip()
+
+def _context(texts: list[str], nonempty: list[int], idx: int, left_n=3, right_n=3) -> str:
+    """Word idx plus its nearest non-empty neighbours, from the page's precomputed texts."""
+    pos = bisect.bisect_left(nonempty, idx)
+    left = [texts[j] for j in nonempty[max(0, pos - left_n):pos]]
+    if pos < len(nonempty) and nonempty[pos] == idx:
+        pos += 1
+    right = [texts[j] for j in nonempty[pos:pos + right_n]]
+    return " ".join(left + [texts[idx]] + right)
+
+def _process_page(pg: dict, keep=PII_CATEGORIES) -> tuple[dict, dict, Any, int]:
+    """One page's report columns, per-type counts, page number and hit count (categories in keep only)."""
+    cols = {k: [] for k in _COLUMNS}
+    add_page, add_index, add_type, add_source, add_text = (
+        cols["page"].append, cols["index"].append, cols["type"].append,
+        cols["source"].append, cols["text"].append,
+    )
+    add_conf, add_bbox, add_width, add_height, add_context, add_bbox_json = (
+        cols["confidence"].append, cols["bbox"].append, cols["page_width"].append,
+        cols["page_height"].append, cols["context"].append, cols["bbox_json"].append,
+    )
+    by_type = {}
+    # hot-loop helpers as locals
+    norm, safe, context, dumps = normalize_type, _safe_text, _context, json.dumps
+
+    page_no = pg.get("page")
+    width, height = pg.get("width"), pg.get("height")
+    words = pg.get("words", [])
+    # strip each word once per page; context lookups then slice the non-empty index list
+    texts = [safe(w.get("text")) for w in words]
+    nonempty = [j for j, t in enumerate(texts) if t]
+    hits = 0
+    for i, w in enumerate(words):
+        pii = w.get("pii") or {}
+        if not pii.get("is_pii"):
+            continue
+        typ = norm(pii.get("type"))
+        if typ not in keep:
+            continue
+        conf = w.get("conf")
+        try:
+            conf = float(conf) if conf is not None else None
+        except Exception:
+            conf = None
+        add_page(page_no)
+        add_index(i)
+        add_type(typ)
+        add_source(safe(pii.get("source") or "unknown"))
+        add_text(texts[i])
+        add_conf(conf)
+        bbox = w.get("bbox") or w.get("box") or w.get("bbox_px")
+        add_bbox(bbox)
+        add_bbox_json(dumps(bbox))
+        add_width(width)
+        add_height(height)
+        add_context(context(texts, nonempty, i, 3, 3))
+        by_type[typ] = by_type.get(typ, 0) + 1
+        hits += 1
+    return cols, by_type, page_no, hits
+
+def build_redaction_report(pii_data: dict | pathlib.Path, keep_types: Iterable[str] | None = None) -> dict:
+    """
+    Build a detailed report from the with_pii data — an already-parsed dict, or a path
+    to with_pii.json that is streamed page by page. Only hits whose normalized type is
+    in keep_types (default: all categories) are reported.
+    Items are stored column-wise (one list per field, rows aligned by position):
+      {
+        "summary": {"total": int, "by_type": {type: count}, "by_page": {page: count}},
+        "columns": {
+          "page": [int], "index": [int], "type": [str], "source": [str],
+          "text": [str], "confidence": [float|None],
+          "bbox": [[x0,y0,x1,y1] or {"x","y","w","h"}],
+          "page_width": [int], "page_height": [int],
+          "context": [str],
+          "bbox_json": [str]   # bbox already JSON-encoded for the CSV export
+        }
+      }
+    """
+    cols = {k: [] for k in _COLUMNS}
+    by_type, by_page = {}, {}
+    keep = PII_CATEGORIES if keep_types is None else frozenset(keep_types)
+
+    # a path is streamed page by page, so only one page's words are materialized at a time
+    pages = pii_data.get("pages", []) if isinstance(pii_data, dict) else jsonio.iter_pages(pii_data)
+    for page_cols, page_types, page_no, hits in (_process_page(pg, keep) for pg in pages):
+        if not hits:
+            continue
+        for k, v in page_cols.items():
+            cols[k].extend(v)
+        for typ, n in page_types.items():
+            by_type[typ] = by_type.get(typ, 0) + n
+        by_page[page_no] = by_page.get(page_no, 0) + hits
+
+    return {
+        "summary": {
+            "total": len(cols["page"]),
+            "by_type": by_type,
+            "by_page": by_page,
+        },
+        "columns": cols,
+    }
+
+def report_items(report: dict) -> list[dict]:
+    """Row-wise view of the report's columns (one dict per redaction)."""
+    cols = report["columns"]
+    return [dict(zip(REPORT_FIELDS, row)) for row in zip(*(cols[k] for k in REPORT_FIELDS))]
+
+def report_to_json_bytes(report: dict) -> bytes:
+    return jsonio.dumps({"summary": report["summary"], "items": report_items(report)})
+
+def report_to_csv_bytes(report: dict) -> bytes:
+    # sweep the columns in lockstep and hand the tuples to writerows, which loops in C
+    cols = report["columns"]
+    rows = zip(*(cols[k] for k in _CSV_SOURCES))
+    buf = io.StringIO()
+    wr = csv.writer(buf)
+    wr.writerow(REPORT_FIELDS)
+    wr.writerows(rows)
+    return buf.getvalue().encode("utf-8")
@@ -0,0 +1,20 @@
+# pii_types.py — map the type labels the taggers emit onto the app's PII categories
+
+_ID_ALIASES = {"ssn", "tax_id", "routing_number", "bank_account", "client_id"}
+_NAME_ALIASES = {
+    "name", "person", "personal_name", "full_name", "human_name",
+    "first_name", "last_name", "surname", "given_name"
+}
+
+# flat alias -> UI category table, so normalization is one dict lookup per word
+_TYPE_MAP = {
+    **{t: t for t in ("email", "phone", "ip", "address", "id_number", "password", "other")},
+    **dict.fromkeys(_ID_ALIASES, "id_number"),
+    **dict.fromkeys(_NAME_ALIASES, "name"),
+}
+
+PII_CATEGORIES = frozenset(_TYPE_MAP.values())
+
+def normalize_type(t: str | None) -> str:
+    """Map model/tagger types into UI categories."""
+    return _TYPE_MAP.get(str(t).lower().strip(), "other") if t else "other"
@@ -0,0 +1,113 @@
+# pipeline.py — the OCR / PII / redaction scripts as importable modules,
+# plus the step functions the Streamlit app runs in its long-lived worker process
+import contextlib, importlib.util, multiprocessing, pathlib, sys
+
+from pii_report import build_redaction_report
+
+HERE = pathlib.Path(__file__).parent.resolve()
+
+def _load(name, filename):
+    """Import one of the hyphen-named pipeline scripts as a module."""
+    spec = importlib.util.spec_from_file_location(name, HERE / filename)
+    mod = importlib.util.module_from_spec(spec)
+    # registered before exec so the OCR process pool can pickle its worker functions
+    sys.modules[name] = mod
+    spec.loader.exec_module(mod)
+    return mod
+
+# loaded at import time: spawn-based pool workers re-import their __main__ and need them too
+pos_ocr = _load("pos_ocr", "pos-ocr.py")
+pii_identifier = _load("pii_identifier", "pii-identifier.py")
+redactor = _load("redactor", "redactor.py")
+
+# ----------------- worker process side -----------------
+
+_events = None  # queue shared with the app; set by init_worker
+_job = None     # id of the job being run; tags every event so the app can drop stale ones
+
+def init_worker(events):
+    """Pool initializer: keep the event queue for this worker process."""
+    global _events
+    _events = events
+    if multiprocessing.get_start_method() != "fork":
+        # Spawned OCR page workers re-import __main__ (the streamlit launcher here), which
+        # never loads the scripts; point __main__ at this module so they do. Only run_job is
+        # submitted to this worker, so nothing needs to unpickle from the original __main__.
+        # Forked page workers inherit the loaded modules and need none of this.
+        sys.modules["__main__"] = sys.modules[__name__]
+
+def run_job(job, fn, *args, **kwargs):
+    """Run pipeline step fn in the worker, tagging its events with job."""
+    global _job
+    _job = job
+    try:
+        return fn(*args, **kwargs)
+    finally:
+        _job = None
+
+def _emit(*event):
+    if _events is not None:
+        _events.put((_job,) + event)
+
+class _LogWriter:
+    """stdout/stderr stand-in that forwards complete lines as "log" events."""
+    def __init__(self):
+        self._partial = ""
+
+    def write(self, s):
+        lines = (self._partial + s).split("\n")
+        self._partial = lines.pop()
+        for line in lines:
+            _emit("log", line)
+        return len(s)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if self._partial:
+            _emit("log", self._partial)
+            self._partial = ""
+
+@contextlib.contextmanager
+def _step():
+    """Capture a step's output as events; always ends with a "done" event."""
+    out = _LogWriter()
+    try:
+        with contextlib.redirect_stdout(out), contextlib.redirect_stderr(out):
+            yield
+    except SystemExit as e:
+        # the scripts exit with a message on bad input; don't take the worker down with them
+        msg = e.code if isinstance(e.code, str) else f"exited with status {e.code}"
+        raise RuntimeError(msg) from None
+    finally:
+        out.close()
+        _emit("done",)
+
+def process(in_pdf: str, out_base: str, *, dpi=300, lang="eng", psm="6", tesseract=None,
+            force_ocr=False, tag=True, redacted_pdf=None, keep_types=None, margin=2.0,
+            label=False, label_size=8.0) -> dict:
+    """
+    OCR in_pdf, tag PII on the result (if tag), burn redactions into redacted_pdf (if given)
+    and build the redaction report, all in one job so the with_pii data never leaves this process.
+    keep_types limits redaction and report to those categories (default: all).
+    Returns {"positions_json": path, "with_pii_json": path | None, "boxes": int | None, "report": dict}.
+    """
+    with _step():
+        _emit("progress", 5, "Running OCR…")
+        positions = pos_ocr.run_ocr(in_pdf, out_base, dpi=dpi, lang=lang, psm=psm, tesseract=tesseract,
+                                    force_ocr=force_ocr)
+        result = {"positions_json": f"{out_base}.positions.json", "with_pii_json": None, "boxes": None}
+        pii = {}
+        if tag:
+            _emit("progress", 30, "Identifying PII…")
+            result["with_pii_json"] = f"{out_base}.with_pii.json"
+            pii = pii_identifier.run_pii(positions, result["with_pii_json"])
+            if redacted_pdf:
+                _emit("progress", 70, "Applying redactions…")
+                result["boxes"] = redactor.run_redact(in_pdf, pii, redacted_pdf, dpi=dpi, margin=margin,
+                                                      types="all" if keep_types is None else keep_types,
+                                                      label=label, label_size=label_size)
+        _emit("progress", 85, "Generating redaction report…")
+        result["report"] = build_redaction_report(pii, keep_types=keep_types)
+    return result
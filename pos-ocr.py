@@ -1,7 +1,14 @@
-import sys, os, json, argparse
+import sys, os, argparse, statistics, subprocess, tempfile
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import fitz  # PyMuPDF
-from PIL import Image
 import pytesseract
+import jsonio
+
+try:  # optional in-process Tesseract binding; keeps the model loaded across pages
+    from tesserocr import PyTessBaseAPI, RIL, iterate_level
+except ImportError:
+    PyTessBaseAPI = None
 
 def parse_args():
     p = argparse.ArgumentParser(description="PDF OCR (PyMuPDF) with word boxes")
@@ -9,8 +16,17 @@ def parse_args():
     p.add_argument("out_base", nargs="?", help="Output base name (no extension)")
     p.add_argument("--tesseract", default=None, help="Path to tesseract.exe (Windows)")
     p.add_argument("--dpi", type=int, default=300, help="Render DPI (default 300)")
+    p.add_argument("--probe-dpi", type=int, default=150,
+                   help="OCR first at this DPI and only re-render at --dpi when text is small (0 = off, default 150)")
     p.add_argument("--lang", default="eng", help="Language code (default eng)")
     p.add_argument("--psm", default="6", help="Tesseract PSM (default 6)")
+    p.add_argument("--force-ocr", action="store_true",
+                   help="OCR every page even when the PDF already has a text layer")
+    p.add_argument("--engine", choices=["auto", "tesserocr", "pytesseract", "batch"], default="auto",
+                   help="OCR backend: tesserocr (in-process), pytesseract (tesseract CLI per page) or "
+                        "batch (one tesseract run over all pages); auto picks tesserocr when installed")
+    p.add_argument("--workers", type=int, default=min(os.cpu_count() or 1, 4),
+                   help="Parallel OCR processes (default min(cpu_count, 4))")
     return p.parse_args()
 
 def ensure_tesseract(tesseract_path: str | None):
@@ -23,26 +39,44 @@ def ensure_tesseract(tesseract_path: str | None):
         print("Windows installer: https://github.com/UB-Mannheim/tesseract/wiki", file=sys.stderr)
         sys.exit(1)
 
-def pixmap_to_pil(pix: fitz.Pixmap) -> Image.Image:
+def resolve_engine(engine: str) -> str:
+    if engine == "auto":
+        return "tesserocr" if PyTessBaseAPI is not None else "pytesseract"
+    if engine == "tesserocr" and PyTessBaseAPI is None:
+        print("ERROR: --engine tesserocr requested but tesserocr is not installed.", file=sys.stderr)
+        sys.exit(1)
+    return engine
+
+def pixmap_to_pnm(pix: fitz.Pixmap, path: str) -> str:
+    """Write the raster as uncompressed PNM; handing Tesseract a file path skips the PIL copy and PNG encode/decode."""
     if pix.alpha:  # drop alpha for OCR
         pix = fitz.Pixmap(pix, 0)  # flatten
-    mode = "RGB" if pix.n >= 3 else "L"
-    return Image.frombytes(mode, [pix.width, pix.height], pix.samples)
+    pix.save(path)
+    return path
 
-def ocr_text_and_boxes(img: Image.Image, lang: str, psm: str):
-    cfg = f"--psm {psm}"
-    text = pytesseract.image_to_string(img, lang=lang, config=cfg) or ""
+def lines_to_text(lines: dict) -> str:
+    """Join {(block, par, line): [tokens]} into text; a blank line separates paragraphs like image_to_string."""
+    out, prev = [], None
+    for (block, par, _line), toks in lines.items():
+        if prev is not None and (block, par) != prev:
+            out.append("")
+        out.append(" ".join(toks))
+        prev = (block, par)
+    return "\n".join(out)
 
-    data = pytesseract.image_to_data(img, lang=lang, config=cfg, output_type=pytesseract.Output.DICT)
+def words_from_data(data: dict):
+    """Parse image_to_data-style columns (dict of lists) into (text, words)."""
     words = []
+    lines = defaultdict(list)
     n = len(data.get("text", []))
     for i in range(n):
         t = str(data["text"][i]).strip() if data["text"][i] is not None else ""
         if not t:
             continue
-        # conf may be str or int depending on versions
+        lines[(data["block_num"][i], data["par_num"][i], data["line_num"][i])].append(t)
+        # conf may be str, int or float depending on versions
         try:
-            conf_val = int(data["conf"][i])
+            conf_val = int(float(data["conf"][i]))
         except Exception:
             conf_val = -1
         words.append({
@@ -56,53 +90,259 @@ def ocr_text_and_boxes(img: Image.Image, lang: str, psm: str):
             "conf": conf_val,
             "source": "ocr"
         })
-    return text, words
+    return lines_to_text(lines), words
 
-def main():
-    args = parse_args()
-    ensure_tesseract(args.tesseract)
+def ocr_text_and_boxes(img_path: str, lang: str, psm: str):
+    cfg = f"--psm {psm}"
+    # single Tesseract pass: plain text is rebuilt from the word boxes line by line
+    data = pytesseract.image_to_data(img_path, lang=lang, config=cfg, output_type=pytesseract.Output.DICT)
+    return words_from_data(data)
 
-    pdf_path = args.pdf
-    if not os.path.exists(pdf_path):
-        print(f"ERROR: PDF not found: {pdf_path}", file=sys.stderr)
-        sys.exit(1)
+def _tsv_pages(tsv: str) -> dict:
+    """Split a multi-image Tesseract TSV into {page_num: image_to_data-style dict of lists}."""
+    rows = tsv.splitlines()
+    if not rows:
+        return {}
+    header = rows[0].split("\t")
+    pages = {}
+    for row in rows[1:]:
+        cols = row.split("\t")
+        cols += [""] * (len(header) - len(cols))
+        rec = dict(zip(header, cols))
+        data = pages.setdefault(int(rec["page_num"]), {k: [] for k in header})
+        for k in header:
+            data[k].append(rec[k])
+    return pages
 
-    out_base = args.out_base or os.path.splitext(os.path.basename(pdf_path))[0]
-    out_txt = f"{out_base}.txt"
-    out_json = f"{out_base}.positions.json"
+def ocr_images_batch(img_paths: list, lang: str, psm: str, workdir: str) -> list:
+    """OCR many images with one tesseract process (list-file input, TSV output); one (text, words) per image."""
+    list_file = os.path.join(workdir, "pages.txt")
+    with open(list_file, "w", encoding="utf-8") as f:
+        f.write("\n".join(img_paths) + "\n")
+    out_base = os.path.join(workdir, "out")
+    subprocess.run(
+        [pytesseract.pytesseract.tesseract_cmd, list_file, out_base, "-l", lang, "--psm", str(psm), "tsv"],
+        check=True, capture_output=True,
+    )
+    with open(out_base + ".tsv", "r", encoding="utf-8") as f:
+        pages = _tsv_pages(f.read())
+    return [words_from_data(pages.get(i + 1, {})) for i in range(len(img_paths))]
 
-    doc = fitz.open(pdf_path)
-    positions = {"pages": []}
+def ocr_pixmap_tesserocr(api, pix: fitz.Pixmap):
+    """OCR a pixmap through a loaded PyTessBaseAPI; the raw samples go straight to Tesseract."""
+    api.SetImageBytes(pix.samples, pix.width, pix.height, pix.n, pix.stride)
+    api.Recognize()
+    words = []
+    ri = api.GetIterator()
+    if ri is not None:
+        for r in iterate_level(ri, RIL.WORD):
+            t = (r.GetUTF8Text(RIL.WORD) or "").strip()
+            box = r.BoundingBox(RIL.WORD)
+            if not t or box is None:
+                continue
+            x0, y0, x1, y1 = box
+            words.append({
+                "text": t,
+                "bbox": {"x": x0, "y": y0, "w": x1 - x0, "h": y1 - y0},
+                "conf": int(r.Confidence(RIL.WORD)),
+                "source": "ocr"
+            })
+    return (api.GetUTF8Text() or "").strip(), words
 
-    with open(out_txt, "w", encoding="utf-8") as txtout:
+MIN_NATIVE_WORDS = 3  # fewer embedded words than this → treat the page as scanned
+# images over this share of the page → scanned body (a stamped header/footer may be the only text), OCR it
+SCANNED_IMAGE_COVER = 0.5
+
+def native_text_and_boxes(native_words: list, zoom: float):
+    """Convert page.get_text("words") tuples (PDF points) into OCR-style words in render pixels."""
+    words = []
+    lines = defaultdict(list)
+    for x0, y0, x1, y1, t, block, line, _wno in native_words:
+        t = t.strip()
+        if not t:
+            continue
+        lines[(block, 0, line)].append(t)
+        words.append({
+            "text": t,
+            "bbox": {
+                "x": int(round(x0 * zoom)),
+                "y": int(round(y0 * zoom)),
+                "w": int(round((x1 - x0) * zoom)),
+                "h": int(round((y1 - y0) * zoom)),
+            },
+            "conf": 100,
+            "source": "pdf"
+        })
+    return lines_to_text(lines), words
+
+def _image_cover(page: fitz.Page) -> float:
+    """Share of the page area covered by placed images (capped at 1)."""
+    area = abs(page.rect) or 1.0
+    covered = sum(abs(fitz.Rect(info["bbox"]) & page.rect) for info in page.get_image_info())
+    return min(covered / area, 1.0)
+
+def _native_page(page: fitz.Page, dpi: int):
+    """Born-digital page: (text, words, width_px, height_px, dpi) from the text layer, or None to OCR it."""
+    native = page.get_text("words")
+    if len(native) < MIN_NATIVE_WORDS or _image_cover(page) >= SCANNED_IMAGE_COVER:
+        return None
+    zoom = dpi / 72.0
+    text, words = native_text_and_boxes(native, zoom)
+    size = (page.rect * fitz.Matrix(zoom, zoom)).irect
+    return text, words, size.width, size.height, dpi
+
+_API = None  # per-worker tesserocr handle, created once by _init_worker
+
+def _init_worker(tesseract_path: str | None, engine: str = "pytesseract", lang: str = "eng", psm: str = "6"):
+    global _API
+    if tesseract_path:
+        pytesseract.pytesseract.tesseract_cmd = tesseract_path
+    if engine == "tesserocr":
+        _API = PyTessBaseAPI(lang=lang, psm=int(psm))
+
+def _ocr_page(page: fitz.Page, page_num: int, dpi: int, lang: str, psm: str):
+    """Render one page at dpi and OCR it; returns (text, words, width_px, height_px)."""
+    zoom = dpi / 72.0
+    pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), alpha=False)
+    if _API is not None:
+        text, words = ocr_pixmap_tesserocr(_API, pix)
+        return text, words, pix.width, pix.height
+    with tempfile.TemporaryDirectory() as tmp:
+        img_path = pixmap_to_pnm(pix, os.path.join(tmp, f"page_{page_num + 1:04d}.pnm"))
+        text, words = ocr_text_and_boxes(img_path, lang, psm)
+    return text, words, pix.width, pix.height
+
+MIN_TEXT_HEIGHT_PX = 18  # median word height below this at the probe DPI → re-OCR at full DPI
+
+def _text_too_small(words: list) -> bool:
+    heights = [w["bbox"]["h"] for w in words if w["conf"] > 50]
+    return not heights or statistics.median(heights) < MIN_TEXT_HEIGHT_PX
+
+def _render_and_ocr(pdf_path: str, page_num: int, dpi: int, lang: str, psm: str,
+                    force_ocr: bool = False, probe_dpi: int = 0):
+    """Returns (page_num, text, words, width_px, height_px, dpi actually used for the boxes)."""
+    # each worker opens its own document; fitz handles can't be shared across processes
+    with fitz.open(pdf_path) as doc:
+        page = doc[page_num]
+        if not force_ocr:
+            native = _native_page(page, dpi)
+            if native is not None:
+                return (page_num, *native)
+        if probe_dpi and probe_dpi < dpi:
+            # cheap pass first; body text is usually big enough to read at the probe DPI
+            text, words, width, height = _ocr_page(page, page_num, probe_dpi, lang, psm)
+            if not _text_too_small(words):
+                return page_num, text, words, width, height, probe_dpi
+        text, words, width, height = _ocr_page(page, page_num, dpi, lang, psm)
+    return page_num, text, words, width, height, dpi
+
+def _ocr_document_batch(doc: fitz.Document, dpi: int, lang: str, psm: str, force_ocr: bool = False) -> dict:
+    """Render every scanned page to a temp dir and OCR them all in one tesseract run.
+    No probe pass here: all pages are rendered at dpi. Every page sits on disk until the run,
+    so they are written as grayscale PNG (~0.1 MB at 300 dpi, against ~25 MB as RGB PNM)."""
+    results = {}
+    zoom = dpi / 72.0
+    mat = fitz.Matrix(zoom, zoom)
+    with tempfile.TemporaryDirectory() as tmp:
+        queued = []  # (page_num, image path, width, height)
         for page_num in range(len(doc)):
             page = doc[page_num]
-            # render with DPI scaling
-            zoom = args.dpi / 72.0
-            mat = fitz.Matrix(zoom, zoom)
-            pix = page.get_pixmap(matrix=mat, alpha=False)
-            img = pixmap_to_pil(pix)
+            native = None if force_ocr else _native_page(page, dpi)
+            if native is not None:
+                results[page_num] = native
+                continue
+            # Tesseract binarizes from gray anyway, and gray renders faster than RGB
+            pix = page.get_pixmap(matrix=mat, colorspace=fitz.csGRAY, alpha=False)
+            img_path = os.path.join(tmp, f"page_{page_num + 1:04d}.png")
+            pix.save(img_path)
+            queued.append((page_num, img_path, pix.width, pix.height))
+        if queued:
+            ocr = ocr_images_batch([q[1] for q in queued], lang, psm, tmp)
+            for (page_num, _, width, height), (text, words) in zip(queued, ocr):
+                results[page_num] = (text, words, width, height, dpi)
+    return results
+
+def _ocr_document_pool(pdf_path: str, dpi: int, lang: str, psm: str, force_ocr: bool, probe_dpi: int,
+                       workers: int, tesseract: str | None, engine: str, doc: fitz.Document | None = None) -> dict:
+    if doc is not None:
+        npages = len(doc)
+    else:
+        with fitz.open(pdf_path) as d:
+            npages = len(d)
 
-            # OCR
-            text, words = ocr_text_and_boxes(img, args.lang, args.psm)
+    # pages are independent: render + OCR them in parallel processes
+    results = {}
+    with ProcessPoolExecutor(max_workers=max(1, workers),
+                             initializer=_init_worker, initargs=(tesseract, engine, lang, psm)) as ex:
+        futures = [ex.submit(_render_and_ocr, pdf_path, i, dpi, lang, psm, force_ocr, probe_dpi)
+                   for i in range(npages)]
+        for fut in as_completed(futures):
+            page_num, text, words, width, height, page_dpi = fut.result()
+            results[page_num] = (text, words, width, height, page_dpi)
+            print(f"page {page_num + 1}/{npages}: {len(words)} words @ {page_dpi} dpi")
+    return results
+
+def run_ocr(pdf_path: str, out_base: str | None = None, dpi: int = 300, lang: str = "eng",
+            psm: str = "6", workers: int | None = None, tesseract: str | None = None,
+            force_ocr: bool = False, engine: str = "auto", probe_dpi: int = 150,
+            doc: fitz.Document | None = None) -> dict:
+    """OCR every page of pdf_path, write <out_base>.txt / .positions.json and return the positions dict.
+    Pass an already-open doc to avoid reopening the PDF in the calling process."""
+    engine = resolve_engine(engine)
+    if engine in ("pytesseract", "batch"):
+        ensure_tesseract(tesseract)
+    workers = workers or min(os.cpu_count() or 1, 4)
+
+    out_base = out_base or os.path.splitext(os.path.basename(pdf_path))[0]
+    out_txt = f"{out_base}.txt"
+    out_json = f"{out_base}.positions.json"
+
+    if engine == "batch":
+        # one tesseract process for the whole document instead of one per page
+        if doc is not None:
+            results = _ocr_document_batch(doc, dpi, lang, psm, force_ocr)
+        else:
+            with fitz.open(pdf_path) as d:
+                results = _ocr_document_batch(d, dpi, lang, psm, force_ocr)
+        npages = len(results)
+        for page_num in sorted(results):
+            print(f"page {page_num + 1}/{npages}: {len(results[page_num][1])} words")
+    else:
+        results = _ocr_document_pool(pdf_path, dpi, lang, psm, force_ocr, probe_dpi,
+                                     workers, tesseract, engine, doc=doc)
+
+    positions = {"pages": []}
+    with open(out_txt, "w", encoding="utf-8") as txtout:
+        for page_num in sorted(results):
+            text, words, width, height, page_dpi = results[page_num]
 
             # write page text
             txtout.write(f"\n===== Page {page_num + 1} =====\n{text}\n")
 
             positions["pages"].append({
                 "page": page_num + 1,
-                "width": img.width,
-                "height": img.height,
+                "width": width,
+                "height": height,
+                "dpi": page_dpi,
                 "words": words
             })
 
-            print(f"page {page_num + 1}/{len(doc)}: {len(words)} words")
-
-    with open(out_json, "w", encoding="utf-8") as f:
-        json.dump(positions, f, indent=2)
+    jsonio.dump(positions, out_json)
 
     print(f"[OK] wrote {out_txt}")
     print(f"[OK] wrote {out_json}")
+    return positions
+
+def main():
+    args = parse_args()
+
+    if not os.path.exists(args.pdf):
+        print(f"ERROR: PDF not found: {args.pdf}", file=sys.stderr)
+        sys.exit(1)
+
+    run_ocr(args.pdf, args.out_base, dpi=args.dpi, lang=args.lang, psm=args.psm,
+            workers=args.workers, tesseract=args.tesseract, force_ocr=args.force_ocr,
+            engine=args.engine, probe_dpi=args.probe_dpi)
 
 if __name__ == "__main__":
     main()
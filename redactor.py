@@ -2,13 +2,17 @@
 # Usage:
 #   python redactor.py input.pdf input.with_pii.json output.redacted.pdf
 #                      [--dpi 300] [--margin 2]
-#                      [--types email,phone,name,address,ip,id_number,other]
-#                      [--label] [--label-size 8]
+#                      [--types email,phone,name,address,ip,id_number,password,other]
+#                      [--label] [--label-size 8] [--no-merge]
 #
-import argparse, json, sys
+import argparse, sys
+from collections import Counter
 import fitz  # PyMuPDF
+import numpy as np
+import jsonio
+from pii_types import PII_CATEGORIES, normalize_type
 
-ALL_TYPES = {"name","email","phone","address","ip","id_number","other"}
+ALL_TYPES = PII_CATEGORIES
 
 # map pii.type -> short label burned on the box
 TYPE_LABELS = {
@@ -18,6 +22,7 @@ TYPE_LABELS = {
     "address": "ADDRESS",
     "ip": "IP",
     "id_number": "ID",
+    "password": "PASSWORD",
     "other": "OTHER",
 }
 
@@ -26,101 +31,171 @@ def parse_args():
     ap.add_argument("input_pdf")
     ap.add_argument("with_pii_json")
     ap.add_argument("output_pdf")
-    ap.add_argument("--dpi", type=int, default=300, help="OCR render DPI used for positions.json (default 300)")
+    ap.add_argument("--dpi", type=int, default=300, help="OCR render DPI for pages whose JSON has no per-page 'dpi' (default 300)")
     ap.add_argument("--margin", type=float, default=2.0, help="Padding in image pixels around each bbox")
-    ap.add_argument("--types", default="all",
-                    help="Comma-separated PII types to redact (default 'all'). "
-                         "Allowed: name,email,phone,address,ip,id_number,other")
+    ap.add_argument("--types", "--keep-types", dest="types", default="all",
+                    help="Comma-separated PII types to redact (default 'all'); tagger aliases such as "
+                         "'person' or 'ssn' count as their category. "
+                         "Allowed: name,email,phone,address,ip,id_number,password,other")
     # NEW: optional label on black boxes
     ap.add_argument("--label", action="store_true", help="Print a short type label on each redaction box")
     ap.add_argument("--label-size", type=float, default=8.0, help="Label font size (points)")
+    ap.add_argument("--no-merge", action="store_true",
+                    help="Keep one box per word instead of merging adjacent boxes on a line")
     return ap.parse_args()
 
-def load_pages(path):
-    with open(path, "r", encoding="utf-8") as f:
-        data = json.load(f)
+def load_pages(src):
+    """Pages of a with_pii JSON, given its path or the already-loaded dict."""
+    data = src if isinstance(src, dict) else jsonio.load(src)
     pages = data.get("pages")
     if not isinstance(pages, list):
         raise SystemExit("Invalid JSON: missing top-level 'pages' array.")
     return pages
 
 def parse_types(s):
-    if s.strip().lower() == "all":
-        return ALL_TYPES
-    chosen = {t.strip().lower() for t in s.split(",") if t.strip()}
+    """Comma-separated string ("all" for everything) or an iterable of types -> set of categories."""
+    if isinstance(s, str):
+        if s.strip().lower() == "all":
+            return ALL_TYPES
+        s = s.split(",")
+    chosen = {t.strip().lower() for t in s if t.strip()}
     bad = chosen - ALL_TYPES
     if bad:
         print(f"WARNING: unknown types ignored: {', '.join(sorted(bad))}", file=sys.stderr)
     return (chosen & ALL_TYPES) or set()
 
-def expand_bbox(b, margin):
-    return {"x": b["x"] - margin, "y": b["y"] - margin, "w": b["w"] + 2*margin, "h": b["h"] + 2*margin}
-
-def clamp_rect(rect, page_rect):
-    # ensure rect stays within page bounds
-    r = fitz.Rect(rect)
-    r.intersect(page_rect)
-    return r
-
-def px_to_pdf_rect(bbox_px, scale):
-    x0 = bbox_px["x"] * scale
-    y0 = bbox_px["y"] * scale
-    x1 = (bbox_px["x"] + bbox_px["w"]) * scale
-    y1 = (bbox_px["y"] + bbox_px["h"]) * scale
-    return fitz.Rect(x0, y0, x1, y1)
+def bboxes_to_pdf_coords(bboxes, margin, scale, page_rect):
+    """
+    Pixel bboxes ({"x","y","w","h"}) -> (N, 4) float32 array of x0,y0,x1,y1 in PDF points:
+    padded by margin, scaled, and clipped to the page, all as whole-array operations.
+    """
+    coords = np.array([[b["x"], b["y"], b["x"] + b["w"], b["y"] + b["h"]] for b in bboxes],
+                      dtype=np.float32).reshape(-1, 4)
+    coords[:, :2] -= margin
+    coords[:, 2:] += margin
+    coords *= scale
+    lo = [page_rect.x0, page_rect.y0, page_rect.x0, page_rect.y0]
+    hi = [page_rect.x1, page_rect.y1, page_rect.x1, page_rect.y1]
+    np.clip(coords, lo, hi, out=coords)
+    return coords
+
+def _lines(boxes):
+    """Group [(rect, type)] boxes into text lines: a box joins a line when it overlaps the
+    line's first box vertically by at least half the smaller height. Lines come back sorted by x0."""
+    lines = []
+    for b in sorted(boxes, key=lambda b: b[0].y0 + b[0].y1):
+        r = b[0]
+        for line in lines:
+            first = line[0][0]
+            if min(r.y1, first.y1) - max(r.y0, first.y0) >= 0.5 * min(r.height, first.height):
+                line.append(b)
+                break
+        else:
+            lines.append([b])
+    return [sorted(line, key=lambda b: b[0].x0) for line in lines]
+
+def merge_boxes(boxes, keep_clear=None):
+    """
+    Coalesce [(rect, type)] boxes that sit on the same text line and either overlap or
+    are at most about a word-space apart. Each merged box carries the majority type of
+    its words. keep_clear is an optional (N, 2) array of x,y centres of words that are
+    not redacted; two boxes are never merged if the result would cover one of them.
+    """
+    if not boxes:
+        return []
+    if keep_clear is None or not len(keep_clear):
+        keep_clear = None
+    else:
+        cx, cy = keep_clear[:, 0], keep_clear[:, 1]
+
+    merged = []
+    for line in _lines(boxes):
+        cur, types = fitz.Rect(line[0][0]), Counter([line[0][1]])
+        for r, wtype in line[1:]:
+            gap = r.x0 - cur.x1
+            ok = gap < max(cur.height, r.height) * 0.6  # sorted by x0: a negative gap is an overlap
+            if ok and keep_clear is not None:
+                u = cur | r
+                ok = not np.any((cx > u.x0) & (cx < u.x1) & (cy > u.y0) & (cy < u.y1))
+            if ok:
+                cur |= r
+                types[wtype] += 1
+            else:
+                merged.append((cur, types.most_common(1)[0][0]))
+                cur, types = fitz.Rect(r), Counter([wtype])
+        merged.append((cur, types.most_common(1)[0][0]))
+    return merged
 
 def label_for_type(t: str) -> str:
     t = (t or "other").lower()
     return TYPE_LABELS.get(t, "OTHER")
 
-def main():
-    args = parse_args()
-    pages_json = load_pages(args.with_pii_json)
-    wanted = parse_types(args.types)
+def run_redact(input_pdf, with_pii_json, output_pdf, dpi=300, margin=2.0, types="all",
+               label=False, label_size=8.0, merge=True, doc=None) -> int:
+    """
+    Burn redactions for the tagged words into output_pdf; returns the number of boxes.
+    with_pii_json may be a path or the already-loaded with_pii dict.
+    types: "all", a comma-separated string or an iterable of categories to keep.
+    Pass an already-open doc to reuse it instead of reopening input_pdf; the caller then owns closing it.
+    """
+    pages_json = load_pages(with_pii_json)
+    wanted = parse_types(types)
     if not wanted:
         print("No valid PII types selected — nothing to do.", file=sys.stderr)
-        sys.exit(0)
+        return 0
 
-    scale = 72.0 / float(args.dpi)  # pixels -> points
-    doc = fitz.open(args.input_pdf)
+    own_doc = doc is None
+    if own_doc:
+        doc = fitz.open(input_pdf)
 
+    npages = len(doc)
     total = 0
+    touched = []  # pages that received annotations
+    log = []
     for pinfo in pages_json:
         pno1 = int(pinfo.get("page") or 0)
-        if pno1 < 1 or pno1 > len(doc):
+        if pno1 < 1 or pno1 > npages:
             continue
         page = doc[pno1 - 1]
         page_rect = page.rect
+        # pixels -> points; pos-ocr records the DPI each page was rendered at
+        scale = 72.0 / float(pinfo.get("dpi") or dpi)
 
         words = pinfo.get("words") or []
-        boxes = []
+        bboxes, types, clear = [], [], []
         for w in words:
-            pii = w.get("pii") or {}
-            if not pii.get("is_pii"):
-                continue
-            wtype = str(pii.get("type") or "other").lower()
-            if wtype not in wanted:
-                continue
             b = w.get("bbox")
             if not b:
                 continue
-            expanded = expand_bbox(b, args.margin)
-            rect = px_to_pdf_rect(expanded, scale)
-            rect = clamp_rect(rect, page_rect)
-            if rect.width > 0 and rect.height > 0:
-                boxes.append((rect, wtype))
+            pii = w.get("pii") or {}
+            wtype = normalize_type(pii.get("type")) if pii.get("is_pii") else None
+            if wtype not in wanted:
+                clear.append(b)
+                continue
+            bboxes.append(b)
+            types.append(wtype)
+
+        coords = bboxes_to_pdf_coords(bboxes, margin, scale, page_rect)
+        keep = (coords[:, 2] > coords[:, 0]) & (coords[:, 3] > coords[:, 1])
+        boxes = [(fitz.Rect(*row), wtype)
+                 for row, wtype, k in zip(coords.tolist(), types, keep.tolist()) if k]
+        if merge:
+            # centres of the words left visible, which a merged box must not cover
+            clear_pts = bboxes_to_pdf_coords(clear, 0.0, scale, page_rect)
+            clear_pts = (clear_pts[:, :2] + clear_pts[:, 2:]) / 2
+            boxes = merge_boxes(boxes, clear_pts)
 
         added = 0
         for r, wtype in boxes:
             # True redaction annotation; black fill; optional white label text
             try:
-                if args.label:
+                if label:
                     page.add_redact_annot(
                         r,
                         text=label_for_type(wtype),
                         fill=(0, 0, 0),
                         text_color=(1, 1, 1),
-                        fontsize=args.label_size,
+                        fontsize=label_size,
                         cross_out=False,
                     )
                 else:
@@ -132,19 +207,30 @@ def main():
                 added += 1
 
         total += added
-        print(f"page {pno1}: added {added} boxes")
+        if added:
+            touched.append(page)
+        log.append(f"page {pno1}: added {added} boxes")
+    if log:
+        print("\n".join(log))
 
-    # Apply redactions – support both new & old API
+    # Apply redactions – one document-level pass when available, else only the pages we annotated
     apply_doc = getattr(doc, "apply_redactions", None)
     if callable(apply_doc):
         apply_doc()
     else:
-        for p in doc:
-            p.apply_redactions()
+        for page in touched:
+            page.apply_redactions()
 
-    doc.save(args.output_pdf, deflate=True, garbage=4)
-    doc.close()
-    print(f"[OK] redacted {total} boxes to {args.output_pdf}")
+    doc.save(output_pdf, deflate=True, garbage=4)
+    if own_doc:
+        doc.close()
+    print(f"[OK] redacted {total} boxes to {output_pdf}")
+    return total
+
+def main():
+    args = parse_args()
+    run_redact(args.input_pdf, args.with_pii_json, args.output_pdf, dpi=args.dpi, margin=args.margin,
+               types=args.types, label=args.label, label_size=args.label_size, merge=not args.no_merge)
 
 if __name__ == "__main__":
     main()
@@ -1,58 +1,136 @@
 # streamlit_app.py — OCR → PII → Redact pipeline with category toggles,
 # side-by-side PDF preview, and a Redaction Report (JSON/CSV exports)
 
-import csv
-import io
-import json
+import multiprocessing
 import pathlib
-import shlex
-import subprocess
+import queue
+import shutil
 import sys
-from collections import Counter
-from typing import Any
+import threading
+import time
+import types
+import uuid
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 
 import streamlit as st
 from streamlit_pdf_viewer import pdf_viewer    # pdf.js-based component
 import fitz  # PyMuPDF (fallback image rendering)
+import pyarrow as pa  # report preview table
+
+import jsonio  # orjson-backed JSON I/O (stdlib fallback)
+import pipeline  # OCR / PII / redaction steps, run in a worker process
+from pii_report import PREVIEW_FIELDS, report_to_csv_bytes, report_to_json_bytes
 
 HERE = pathlib.Path(__file__).parent.resolve()
 WORKDIR = HERE / "workdir"
 WORKDIR.mkdir(exist_ok=True)
 
+LOG_TAIL_LINES = 400   # lines of pipeline output kept for the log panel
+LOG_REFRESH_S = 0.1    # minimum gap between log panel redraws
+TICK_MIN_PCT = 5       # progress updates closer than this many percent...
+TICK_MIN_S = 0.25      # ...and this many seconds to the last one are dropped
+
 # ----------------- helpers -----------------
 
-def _run(cmd_list, workdir: pathlib.Path):
-    """Run a command and stream logs into an expander; raise on nonzero exit."""
+@st.cache_resource
+def _pipeline_worker():
+    """
+    One long-lived worker process for the pipeline steps (heavy imports are paid once),
+    the queue it reports progress/log events on, and a lock so one run uses it at a time.
+    The worker is spawned, not forked: forking the multi-threaded Streamlit server is unsafe.
+    """
+    ctx = multiprocessing.get_context("spawn")
+    events = ctx.Queue()
+    pool = ProcessPoolExecutor(max_workers=1, mp_context=ctx,
+                               initializer=pipeline.init_worker, initargs=(events,))
+    # A spawned child re-runs the parent's __main__ from its file, which under Streamlit is
+    # this script. Start the worker now, behind an empty __main__, so it only imports pipeline.
+    main = sys.modules["__main__"]
+    sys.modules["__main__"] = types.ModuleType("__main__")
+    try:
+        pool.submit(int).result()
+    finally:
+        sys.modules["__main__"] = main
+    return pool, events, threading.Lock()
+
+def _progress_ticker(status, bar):
+    """
+    Return tick(pct, msg=None), which updates the progress bar and status line.
+    Each update is a websocket message, so near-duplicates are skipped: a tick with
+    no new message is dropped if it is within TICK_MIN_PCT and TICK_MIN_S of the last one.
+    """
+    last = {"pct": None, "msg": None, "t": 0.0}
+
+    def tick(pct: int, msg: str | None = None):
+        now = time.monotonic()
+        new_msg = msg is not None and msg != last["msg"]
+        if (not new_msg and last["pct"] is not None
+                and abs(pct - last["pct"]) < TICK_MIN_PCT and now - last["t"] < TICK_MIN_S):
+            return
+        if pct != last["pct"]:
+            bar.progress(pct)
+            last["pct"] = pct
+        if new_msg:
+            status.text(msg)
+            last["msg"] = msg
+        last["t"] = now
+
+    return tick
+
+def _run_step(fn, *args, tick=None, **kwargs):
+    """Run a pipeline step in the worker, streaming its logs into an expander; stop the app on failure."""
+    pool, events, lock = _pipeline_worker()
     with st.expander("Logs", expanded=False):
-        st.write("```bash\n" + " ".join(shlex.quote(c) for c in cmd_list) + "\n```")
+        st.write(f"`{fn.__name__}`")
         ph = st.empty()
-        p = subprocess.Popen(
-            cmd_list,
-            cwd=str(workdir),
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT,
-            text=True,
-        )
-        buf = []
-        while True:
-            line = p.stdout.readline()
-            if not line and p.poll() is not None:
-                break
-            if line:
-                buf.append(line)
-                ph.code("".join(buf)[-4000:])
-        code = p.wait()
-        if code != 0:
-            st.error(f"Command failed ({code}). See logs above.")
-            st.stop()
+        # keep only the recent tail; redraw when it changed, at most every LOG_REFRESH_S
+        tail = deque(maxlen=LOG_TAIL_LINES)
+        last_draw = 0.0
+        dirty = False
+        with lock:
+            # events of a step left running by an interrupted earlier run carry another id
+            job = uuid.uuid4().hex
+            fut = pool.submit(pipeline.run_job, job, fn, *args, **kwargs)
+            done = False
+            while not done:
+                try:
+                    event = events.get(timeout=0.05)
+                except queue.Empty:
+                    # a failed call may never reach its "done" event (e.g. the worker died)
+                    done = fut.done() and fut.exception() is not None
+                else:
+                    if event[0] != job:
+                        continue
+                    kind = event[1]
+                    if kind == "log":
+                        tail.append(event[2] + "\n")
+                        dirty = True
+                    elif kind == "progress" and tick is not None:
+                        tick(event[2], event[3])
+                    elif kind == "done":
+                        done = True
+                now = time.monotonic()
+                if dirty and (done or now - last_draw > LOG_REFRESH_S):
+                    ph.code("".join(tail)[-4000:])
+                    last_draw = now
+                    dirty = False
+        try:
+            return fut.result()
+        except BrokenProcessPool:
+            _pipeline_worker.clear()  # start a fresh worker next time
+            st.error("Pipeline worker crashed. See logs above.")
+        except Exception as e:
+            st.error(f"{fn.__name__} failed: {e} — see logs above.")
+        st.stop()
 
 def _is_positions_json(path: pathlib.Path) -> bool:
     """Quick sanity check: JSON file exists and has a top-level 'pages' list."""
     try:
         if not path.exists() or path.suffix.lower() != ".json":
             return False
-        data = json.loads(path.read_text(encoding="utf-8", errors="ignore"))
-        return isinstance(data, dict) and isinstance(data.get("pages"), list)
+        return jsonio.has_pages(path)
     except Exception:
         return False
 
@@ -71,14 +149,17 @@ def _find_positions_json(workdir: pathlib.Path, out_base: pathlib.Path) -> pathl
             return p
     return None
 
-def render_pdf_in_streamlit(pdf_path: pathlib.Path, *, width=800, height=720):
+def render_pdf_in_streamlit(pdf_path: pathlib.Path, *, data: bytes | None = None, width=800, height=720):
     """
     Try pdf_viewer with BYTES, then PATH, else fallback to images.
     Handles version differences of streamlit-pdf-viewer and avoids blanks.
+    Pass `data` when the caller already holds the file's bytes.
     """
+    if data is None:
+        data = pdf_path.read_bytes()
     # try BYTES
     try:
-        pdf_viewer(pdf_path.read_bytes(), width=width, height=height)
+        pdf_viewer(data, width=width, height=height)
         return
     except Exception:
         pass
@@ -88,158 +169,17 @@ def render_pdf_in_streamlit(pdf_path: pathlib.Path, *, width=800, height=720):
         return
     except Exception:
         pass
-    # fallback → images
+    # fallback → images (preview-grade: 1.5x zoom, JPEG is far cheaper to encode than PNG)
     try:
-        doc = fitz.open(str(pdf_path))
+        doc = fitz.open(stream=data, filetype="pdf")
         pages = min(len(doc), 10)
         for i in range(pages):
-            pix = doc[i].get_pixmap(matrix=fitz.Matrix(2, 2))
-            st.image(pix.tobytes("png"), use_container_width=True)
+            pix = doc[i].get_pixmap(matrix=fitz.Matrix(1.5, 1.5))
+            st.image(pix.tobytes("jpeg", jpg_quality=75), use_container_width=True)
         doc.close()
     except Exception as e:
         st.error(f"Could not render PDF (fallback failed): {e}")
 
-# ---- PII normalization / filtering ----
-
-_ID_ALIASES = {"ssn", "tax_id", "routing_number", "bank_account", "client_id"}
-_NAME_ALIASES = {
-    "name", "person", "personal_name", "full_name", "human_name",
-    "first_name", "last_name", "surname", "given_name"
-}
-
-def _normalize_type(t: str | None) -> str:
-    """Map model/tagger types into UI categories."""
-    if not t:
-        return "other"
-    t = str(t).lower().strip()
-    if t in _NAME_ALIASES:
-        return "name"
-    if t in {"email", "phone", "ip", "address", "id_number", "password", "other"}:
-        return t
-    if t in _ID_ALIASES:
-        return "id_number"
-    return "other"
-
-def filter_pii(in_json: pathlib.Path, out_json: pathlib.Path, keep_types: list[str]) -> pathlib.Path:
-    """
-    Turn off PII flags for tokens whose normalized type is NOT in keep_types.
-    Unknowns become non-PII unless 'other' is selected.
-    """
-    data = json.loads(in_json.read_text(encoding="utf-8"))
-    pages = data.get("pages", [])
-    for page in pages:
-        for w in page.get("words", []):
-            pii = w.get("pii") or {}
-            if not pii.get("is_pii"):
-                continue
-            t = _normalize_type(pii.get("type"))
-            if t not in keep_types:
-                w["pii"]["is_pii"] = False
-                w["pii"]["type"] = None
-    out_json.write_text(json.dumps(data, indent=2), encoding="utf-8")
-    return out_json
-
-# ---- Report helpers ----
-
-def _safe_text(x: Any) -> str:
-    s = x if isinstance(x, str) else ("" if x is None else str(x))
-    return s.strip()
-
-def _collect_context(words, idx, left_n=3, right_n=3) -> str:
-    left = []
-    j = idx - 1
-    while j >= 0 and len(left) < left_n:
-        t = _safe_text(words[j].get("text"))
-        if t:
-            left.append(t)
-        j -= 1
-    left.reverse()
-    center = _safe_text(words[idx].get("text"))
-    right = []
-    j = idx + 1
-    while j < len(words) and len(right) < right_n:
-        t = _safe_text(words[j].get("text"))
-        if t:
-            right.append(t)
-        j += 1
-    return " ".join(left + [center] + right)
-
-def build_redaction_report(pii_json_path: pathlib.Path) -> dict:
-    """
-    Build a detailed report from the (filtered) with_pii.json.
-    Returns:
-      {
-        "summary": {"total": int, "by_type": {type: count}, "by_page": {page: count}},
-        "items": [
-          {
-            "page": int, "index": int, "type": str, "source": str,
-            "text": str, "confidence": float|None,
-            "bbox": [x0,y0,x1,y1] or {"x","y","w","h"},
-            "page_width": int, "page_height": int,
-            "context": str
-          }, ...
-        ]
-      }
-    """
-    data = json.loads(pii_json_path.read_text(encoding="utf-8"))
-    items = []
-    by_type, by_page = Counter(), Counter()
-    total = 0
-
-    for pg in data.get("pages", []):
-        page_no = pg.get("page")
-        width, height = pg.get("width"), pg.get("height")
-        words = pg.get("words", [])
-        for i, w in enumerate(words):
-            pii = w.get("pii") or {}
-            if not pii.get("is_pii"):
-                continue
-            typ = _normalize_type(pii.get("type"))
-            src = _safe_text(pii.get("source") or "unknown")
-            text = _safe_text(w.get("text"))
-            conf = w.get("conf")
-            try:
-                conf = float(conf) if conf is not None else None
-            except Exception:
-                conf = None
-            bbox = w.get("bbox") or w.get("box") or w.get("bbox_px")
-            items.append({
-                "page": page_no,
-                "index": i,
-                "type": typ,
-                "source": src,
-                "text": text,
-                "confidence": conf,
-                "bbox": bbox,
-                "page_width": width,
-                "page_height": height,
-                "context": _collect_context(words, i, 3, 3),
-            })
-            by_type[typ] += 1
-            by_page[page_no] += 1
-            total += 1
-
-    return {
-        "summary": {
-            "total": total,
-            "by_type": dict(by_type),
-            "by_page": dict(by_page),
-        },
-        "items": items,
-    }
-
-def report_to_csv_bytes(report: dict) -> bytes:
-    buf = io.StringIO()
-    wr = csv.writer(buf)
-    wr.writerow(["page","index","type","source","text","confidence","bbox","page_width","page_height","context"])
-    for r in report["items"]:
-        wr.writerow([
-            r.get("page"), r.get("index"), r.get("type"), r.get("source"),
-            r.get("text"), r.get("confidence"), json.dumps(r.get("bbox")),
-            r.get("page_width"), r.get("page_height"), r.get("context"),
-        ])
-    return buf.getvalue().encode("utf-8")
-
 # ----------------- UI -----------------
 
 st.set_page_config(page_title="PDF PII Redactor", page_icon="🕶️", layout="wide")
@@ -251,6 +191,7 @@ with st.sidebar:
     psm = st.text_input("Tesseract PSM", value="6")
     lang = st.text_input("Tesseract language", value="eng")
     tesseract_path = st.text_input("Path to tesseract.exe (optional)", value="")
+    force_ocr = st.checkbox("Force OCR (ignore PDF text layers)", value=False)
     margin = st.number_input("Redaction padding (px)", min_value=0, max_value=20, value=3, step=1)
     label_boxes = st.checkbox("Print type label on redaction boxes", value=True)
     label_size = st.number_input("Label font size (pt)", min_value=6.0, max_value=18.0, value=8.0, step=0.5)
@@ -279,121 +220,76 @@ if run_btn:
         st.error("Upload a PDF first.")
         st.stop()
 
-    # clean out old files in workdir (don’t nuke dirs)
-    for f in WORKDIR.iterdir():
-        try:
-            if f.is_file():
-                f.unlink()
-        except Exception:
-            pass
+    # start every run from an empty workdir
+    shutil.rmtree(WORKDIR, ignore_errors=True)
+    WORKDIR.mkdir(exist_ok=True)
 
-    status = st.empty()
-    bar = st.progress(0)
+    tick = _progress_ticker(st.empty(), st.progress(0))
 
     in_pdf = WORKDIR / pdf_file.name
     in_pdf.write_bytes(pdf_file.read())
     out_base = WORKDIR / in_pdf.stem
 
-    positions_json = None
-    with_pii_path = None
-    filtered_pii_path = None
     redacted_pdf = out_base.with_suffix(".redacted.pdf")
 
+    # Category selection: applied by the redactor and the report, no filtered copy of the JSON
+    keep_types = []
+    if redact_names: keep_types.append("name")
+    if redact_email: keep_types.append("email")
+    if redact_phone: keep_types.append("phone")
+    if redact_ip: keep_types.append("ip")
+    if redact_address: keep_types.append("address")
+    if redact_id: keep_types.append("id_number")
+    if redact_password: keep_types.append("password")
+    if redact_other: keep_types.append("other")
+
+    if run_redact and not run_pii:
+        st.error("Redaction needs a '*.with_pii.json'. Enable PII identification.")
+        st.stop()
+
     try:
-        # Step 1: OCR
-        status.text("Running OCR…")
-        cmd = [
-            sys.executable, str(HERE / "pos-ocr.py"),
-            str(in_pdf), str(out_base),
-            "--dpi", str(dpi), "--lang", lang, "--psm", psm,
-        ]
-        if tesseract_path.strip():
-            cmd += ["--tesseract", tesseract_path.strip()]
-        _run(cmd, HERE)
-        bar.progress(30)
+        # OCR → PII (Gemini) → redaction → report in one worker job: the with_pii data
+        # stays in the worker and only the report comes back
+        tick(0, "Running OCR…")
+        result = _run_step(
+            pipeline.process, str(in_pdf), str(out_base),
+            dpi=int(dpi), lang=lang, psm=psm, tesseract=tesseract_path.strip() or None,
+            force_ocr=force_ocr, tag=run_pii,
+            redacted_pdf=str(redacted_pdf) if run_redact else None, keep_types=keep_types,
+            margin=float(margin), label=label_boxes, label_size=float(label_size),
+            tick=tick,
+        )
 
         positions_json = _find_positions_json(WORKDIR, out_base)
         if not positions_json:
             st.error("Could not locate positions JSON produced by pos-ocr.py.")
             st.stop()
+        with_pii_path = result["with_pii_json"]
 
-        # Step 2: PII (Gemini)
-        if run_pii:
-            status.text("Identifying PII…")
-            with_pii_path = out_base.with_suffix(".with_pii.json")
-            cmd = [
-                sys.executable, str(HERE / "pii-identifier.py"),
-                str(positions_json), str(with_pii_path),
-            ]
-            _run(cmd, HERE)
-            bar.progress(60)
-
-            # Category filter
-            status.text("Filtering selected categories…")
-            keep_types = []
-            if redact_names: keep_types.append("name")
-            if redact_email: keep_types.append("email")
-            if redact_phone: keep_types.append("phone")
-            if redact_ip: keep_types.append("ip")
-            if redact_address: keep_types.append("address")
-            if redact_id: keep_types.append("id_number")
-            if redact_password: keep_types.append("password")
-            if redact_other: keep_types.append("other")
-
-            filtered_pii_path = out_base.with_suffix(".filtered_pii.json")
-            with_pii_path = filter_pii(with_pii_path, filtered_pii_path, keep_types)
-            bar.progress(70)
-        else:
-            bar.progress(55)
-
-        # Step 3: Redaction
-        if run_redact:
-            if not with_pii_path or not pathlib.Path(with_pii_path).exists():
-                st.error("Redaction needs a '*.with_pii.json'. Enable PII or provide one.")
-                st.stop()
-            status.text("Applying redactions…")
-            cmd = [
-                sys.executable, str(HERE / "redactor.py"),
-                str(in_pdf), str(with_pii_path), str(redacted_pdf),
-                "--dpi", str(dpi), "--margin", str(margin),
-            ]
-            if label_boxes:
-                cmd += ["--label", "--label-size", str(label_size)]
-            _run(cmd, HERE)
-            bar.progress(85)
-        else:
-            bar.progress(80)
-
-        # Step 4: Redaction Report
-        status.text("Generating redaction report…")
-        if with_pii_path and pathlib.Path(with_pii_path).exists():
-            report = build_redaction_report(pathlib.Path(with_pii_path))
-            report_json_bytes = json.dumps(report, indent=2).encode("utf-8")
-            report_csv_bytes = report_to_csv_bytes(report)
-        else:
-            report = {"summary": {"total": 0, "by_type": {}, "by_page": {}}, "items": []}
-            report_json_bytes = json.dumps(report, indent=2).encode("utf-8")
-            report_csv_bytes = report_to_csv_bytes(report)
+        report = result["report"]
+        report_json_bytes = report_to_json_bytes(report)
+        report_csv_bytes = report_to_csv_bytes(report)
 
-        bar.progress(100)
-        status.text("Done")
+        tick(100, "Done")
         st.success("Pipeline complete.")
 
         # Side-by-side previews
         col1, col2 = st.columns(2, gap="large")
         with col1:
             st.subheader("Input PDF")
-            render_pdf_in_streamlit(in_pdf)
-            st.download_button("Download input PDF", in_pdf.read_bytes(), file_name=in_pdf.name)
+            in_bytes = in_pdf.read_bytes()
+            render_pdf_in_streamlit(in_pdf, data=in_bytes)
+            st.download_button("Download input PDF", in_bytes, file_name=in_pdf.name)
 
         with col2:
             if redacted_pdf.exists():
                 st.subheader("Redacted PDF")
-                render_pdf_in_streamlit(redacted_pdf)
-                st.download_button("Download redacted PDF", redacted_pdf.read_bytes(), file_name=redacted_pdf.name)
+                redacted_bytes = redacted_pdf.read_bytes()
+                render_pdf_in_streamlit(redacted_pdf, data=redacted_bytes)
+                st.download_button("Download redacted PDF", redacted_bytes, file_name=redacted_pdf.name)
             else:
                 st.subheader("Redacted PDF")
-                st.info("Run with redaction enabled to see output here.")
+                st.info("No redacted PDF: redaction is disabled or no categories are selected.")
 
         # ---- Redaction Report ----
         st.divider()
@@ -408,14 +304,9 @@ if run_btn:
             st.write("**By Page**")
             st.json(s.get("by_page", {}))
 
-        if report["items"]:
-            preview = [
-                {
-                    "page": r["page"], "type": r["type"], "source": r["source"],
-                    "text": r["text"], "confidence": r["confidence"], "context": r["context"],
-                }
-                for r in report["items"][:500]
-            ]
+        if s.get("total"):
+            # hand Streamlit an Arrow table straight from the report columns
+            preview = pa.table({k: report["columns"][k] for k in PREVIEW_FIELDS}).slice(0, 500)
             st.dataframe(preview, use_container_width=True, hide_index=True)
         else:
             st.info("No redactions recorded under the selected categories.")
@@ -447,7 +338,7 @@ if run_btn:
                 file_name=pathlib.Path(positions_json).name,
             )
         if with_pii_path and pathlib.Path(with_pii_path).exists():
-            st.write(f"• with_pii (filtered): `{pathlib.Path(with_pii_path).name}`")
+            st.write(f"• with_pii: `{pathlib.Path(with_pii_path).name}`")
             st.download_button(
                 "Download with_pii.json",
                 pathlib.Path(with_pii_path).read_bytes(),